@@ -1,8 +1,41 @@
-from typing import List, Optional
+import json
+import random
+from typing import Dict, List, Optional
+from cshogi import Board
+
+
+def position_key(moves: Optional[List[str]], sfen: str) -> str:
+    """
+    局面のハッシュ値を定跡のキーとして返す(手順違いで同一局面になる場合も同じキー)
+    """
+    board = Board()
+    pos_str = sfen
+    if moves not in (None, []):
+        pos_str += " moves " + " ".join(moves)
+    board.set_position(pos_str)
+    return str(board.zobrist_hash())
+
+
+def load_book(path: str) -> Dict[str, List[dict]]:
+    """
+    build_book.pyで作成した定跡ファイルを読み込む
+    """
+    with open(path) as f:
+        book_data = json.load(f)
+    return book_data["entries"]
 
 
 def get_book_move(moves: Optional[List[str]],
-    sfen: str) -> Optional[str]:
+    sfen: str,
+    book: Optional[Dict[str, List[dict]]] = None) -> Optional[str]:
+    if book:
+        # 定跡ファイルにある局面なら、重みに比例した確率で指し手を選ぶ
+        entries = book.get(position_key(moves, sfen))
+        if entries:
+            return random.choices(
+                [entry["move"] for entry in entries],
+                weights=[entry["weight"] for entry in entries],
+            )[0]
     if sfen != "startpos":
         return None
     if moves is None or moves == []:
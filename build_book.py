@@ -0,0 +1,135 @@
+"""
+usiproxy.pyのログ(tee.log)に含まれる合議結果を局面ごとに集計し、定跡ファイルを作成する
+定跡ファイルには集計途中の統計と各ログの読み取り位置も保存しており、
+再実行時は前回の続きから読むため、新しく追記された対局の分だけが処理される
+"""
+
+import argparse
+import json
+import os
+from book import position_key
+from consultation import extract_consultation_info
+
+ENGINE_OUTPUTS_PREFIX = "info string engine_outputs "
+CONSULT_RESULT_PREFIX = "info string consult "
+
+
+def load_book_data(path):
+    if not os.path.exists(path):
+        return {"sources": {}, "positions": {}, "entries": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_book_data(path, book_data):
+    # 書き込み途中で中断しても既存の定跡ファイルが壊れないよう、一時ファイルから置き換える
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(book_data, f)
+    os.replace(tmp_path, path)
+
+
+def add_consult_record(positions, engine_outputs, consult_obj):
+    moves = consult_obj["moves"] or []
+    sfen = consult_obj["sfen"]
+    score_tuples = consult_obj["score_tuples"]
+    if len(score_tuples) == 0:
+        # 合議が行われなかった時(PVが出なかった場合)
+        return
+    info = extract_consultation_info(engine_outputs, len(moves) + 1, moves, sfen)
+    depths = [pvs[0].depth for pvs in info.engine_pvs if len(pvs) > 0]
+    if len(depths) != len(info.engine_pvs) or None in depths:
+        return
+
+    key = position_key(moves, sfen)
+    position = positions.setdefault(key, {
+        "sfen": sfen,
+        "moves": moves,
+        "move_count": info.move_count,
+        "visits": 0,
+        "depth_sum": 0,
+        "move_stats": {},
+    })
+    position["visits"] += 1
+    # 読みの浅いエンジンの深さを局面の深さとする
+    position["depth_sum"] += min(depths)
+    for move, winrate in score_tuples:
+        move_stat = position["move_stats"].setdefault(move, {"chosen": 0, "count": 0, "winrate_sum": 0.0})
+        move_stat["count"] += 1
+        move_stat["winrate_sum"] += winrate
+    position["move_stats"][score_tuples[0][0]]["chosen"] += 1
+
+
+def process_log(path, offset, positions, encoding):
+    """
+    ログのoffsetバイト目以降を読み、読み終えた位置を返す
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < offset:
+            # ログが作り直されている
+            offset = 0
+        f.seek(offset)
+        engine_outputs = None
+        for raw_line in f:
+            if not raw_line.endswith(b"\n"):
+                # 書き込み途中の行は次回読む
+                break
+            offset += len(raw_line)
+            line = raw_line.decode(encoding, errors="replace").rstrip("\r\n")
+            if line.startswith(ENGINE_OUTPUTS_PREFIX):
+                engine_outputs = json.loads(line[len(ENGINE_OUTPUTS_PREFIX):])
+            elif line.startswith(CONSULT_RESULT_PREFIX):
+                if engine_outputs is not None:
+                    add_consult_record(positions, engine_outputs, json.loads(line[len(CONSULT_RESULT_PREFIX):]))
+                engine_outputs = None
+    return offset
+
+
+def make_entries(positions, min_depth, min_visits, max_move_count):
+    entries = {}
+    for key, position in positions.items():
+        if position["visits"] < min_visits:
+            continue
+        if position["depth_sum"] / position["visits"] < min_depth:
+            continue
+        if position["move_count"] > max_move_count:
+            continue
+        # 合議で選ばれた回数を重みとする
+        book_moves = []
+        for move, move_stat in position["move_stats"].items():
+            if move_stat["chosen"] == 0:
+                continue
+            book_moves.append({
+                "move": move,
+                "weight": move_stat["chosen"],
+                "winrate": move_stat["winrate_sum"] / move_stat["count"],
+            })
+        book_moves.sort(key=lambda x: -x["weight"])
+        entries[key] = book_moves
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("book", help="定跡ファイル(存在すれば追記)")
+    parser.add_argument("logs", nargs="+")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--min_depth", default=10, type=int, help="定跡に採用する局面の最小探索深さ")
+    parser.add_argument("--min_visits", default=2, type=int, help="定跡に採用する局面の最小出現回数")
+    parser.add_argument("--max_move_count", default=32, type=int, help="定跡に採用する最大手数")
+    args = parser.parse_args()
+
+    book_data = load_book_data(args.book)
+    for log_path in args.logs:
+        source_key = os.path.abspath(log_path)
+        offset = book_data["sources"].get(source_key, 0)
+        new_offset = process_log(log_path, offset, book_data["positions"], args.encoding)
+        print(f"{log_path}: {new_offset - offset} bytes processed")
+        book_data["sources"][source_key] = new_offset
+
+    book_data["entries"] = make_entries(book_data["positions"], args.min_depth, args.min_visits, args.max_move_count)
+    print(f"{len(book_data['entries'])} positions in book")
+    save_book_data(args.book, book_data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+対局中の評価値と勝敗を集計し、評価値から勝率への回帰係数(winrate_regression)を対局ごとに更新する
+regress_winrate.pyと同じシグモイドのパラメータを、評価値の区間ごとの出現数・勝ち数から求める
+"""
+
+import json
+import math
+import os
+from typing import Dict, List, Optional
+
+BIN_WIDTH = 100  # 評価値を集計する区間の幅[cp]
+NORMALIZE = 1 / 1200  # regress_winrate.pyのNet.normalizeと同じ
+
+
+def engine_key(engine_idx: int, engine_config) -> str:
+    """
+    集計を区別するキー。評価関数を入れ替えた場合などは、設定ファイルのcalibration_keyを変えて別に集計する
+    Threads・Hash・MultiPVなど、評価値の尺度に影響しないオプションの変更では集計を引き継ぐ
+    """
+    return json.dumps([engine_idx, engine_config["exe"], engine_config.get("calibration_key")])
+
+
+def sigmoid(x: float) -> float:
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+class OnlineCalibration:
+    def __init__(
+        self,
+        path: str,
+        max_cp: int = 3000,
+        prior_count: float = 1000.0,
+        min_games: int = 10,
+        steps: int = 10,
+        lr: float = 0.5,
+    ) -> None:
+        self.path = path
+        self.max_cp = max_cp  # 詰みなど、これより絶対値が大きい評価値は使わない
+        # 設定ファイルの係数から生成する擬似データの総数。少ない対局数で係数が大きく動かないようにする
+        self.prior_count = prior_count
+        self.min_games = min_games  # この対局数に達するまでは設定ファイルの係数を使う
+        self.steps = steps  # 1局ごとの勾配法の反復回数
+        self.lr = lr
+        # キーごとの係数、元になった設定ファイルの係数、対局数、評価値の区間ごとの[出現数, 勝ち数]
+        self.stats = {}  # type: Dict[str, dict]
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stats = json.load(f)
+        self.sources = {}  # type: Dict[str, dict]
+        self.game_scores = {}  # type: Dict[str, List[int]]
+
+    def apply(self, engine_configs) -> None:
+        """
+        読み込んだ直後の設定について、十分な対局数がある保存済みの係数で設定ファイルの係数を置き換える
+        設定ファイルの係数が変わっていれば、保存済みの集計は破棄する
+        """
+        for engine_idx, engine_config in enumerate(engine_configs):
+            key = engine_key(engine_idx, engine_config)
+            source = dict(engine_config["winrate_regression"])
+            self.sources[key] = source
+            stat = self.stats.get(key)
+            if stat is None:
+                continue
+            if stat["source"] != source:
+                del self.stats[key]
+            elif stat["games"] >= self.min_games:
+                engine_config["winrate_regression"] = {"weight": stat["weight"], "bias": stat["bias"]}
+
+    def record(self, key: str, score_cp: int) -> None:
+        if abs(score_cp) > self.max_cp:
+            return
+        self.game_scores.setdefault(key, []).append(score_cp)
+
+    def gameover(self, engine_configs, result: Optional[str]) -> None:
+        """
+        対局中に記録した評価値を勝敗とともに集計し、係数を更新して保存する
+        """
+        game_scores = self.game_scores
+        self.game_scores = {}
+        if result not in ("win", "lose"):
+            # 勝敗以外の結果(千日手など)や、結果が来ない場合は除外
+            return
+        win = 1 if result == "win" else 0
+        for engine_idx, engine_config in enumerate(engine_configs):
+            key = engine_key(engine_idx, engine_config)
+            scores = game_scores.get(key, [])
+            if len(scores) == 0:
+                continue
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self._new_stat(self.sources.get(key, engine_config["winrate_regression"]))
+                self.stats[key] = stat
+            for score_cp in scores:
+                counts = stat["bins"].setdefault(str(round(score_cp / BIN_WIDTH)), [0.0, 0.0])
+                counts[0] += 1
+                counts[1] += win
+            stat["games"] += 1
+            self._fit(stat)
+            if stat["games"] >= self.min_games:
+                engine_config["winrate_regression"] = {"weight": stat["weight"], "bias": stat["bias"]}
+        self._save()
+
+    def _new_stat(self, source: dict) -> dict:
+        """
+        設定ファイルの係数のシグモイドに従う擬似データで初期化する
+        """
+        bin_max = self.max_cp // BIN_WIDTH
+        count = self.prior_count / (bin_max * 2 + 1)
+        bins = {}
+        for bin_idx in range(-bin_max, bin_max + 1):
+            winrate = sigmoid(bin_idx * BIN_WIDTH * source["weight"] + source["bias"])
+            bins[str(bin_idx)] = [count, count * winrate]
+        return {
+            "source": dict(source),
+            "weight": source["weight"],
+            "bias": source["bias"],
+            "games": 0,
+            "bins": bins,
+        }
+
+    def _fit(self, stat: dict) -> None:
+        """
+        現在の係数から、擬似データを含む全データに対するロジスティック回帰の勾配法を数回進める
+        """
+        weight = stat["weight"] / NORMALIZE
+        bias = stat["bias"]
+        for _ in range(self.steps):
+            grad_weight = 0.0
+            grad_bias = 0.0
+            total = 0.0
+            for bin_idx, (count, wins) in stat["bins"].items():
+                x = int(bin_idx) * BIN_WIDTH * NORMALIZE
+                p = sigmoid(x * weight + bias)
+                grad_weight += (p * count - wins) * x
+                grad_bias += p * count - wins
+                total += count
+            weight -= self.lr * grad_weight / total
+            bias -= self.lr * grad_bias / total
+        stat["weight"] = weight * NORMALIZE
+        stat["bias"] = bias
+
+    def _save(self) -> None:
+        # 書き込み途中で中断しても既存のファイルが壊れないよう、一時ファイルから置き換える
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stats, f)
+        os.replace(tmp_path, self.path)
@@ -1,10 +1,15 @@
+from collections import deque
 from dataclasses import dataclass
 import json
+import locale
 import math
-from threading import Lock, Thread
+import time as time_module
+from threading import Event, Lock, Thread, Timer
 from typing import Any, Callable, Dict, List, Optional
 from cshogi.usi.Engine import Engine
-from book import get_book_move
+from book import get_book_move, load_book
+from calibration import OnlineCalibration, engine_key
+from feed import ConsultFeed
 
 
 @dataclass
@@ -12,6 +17,7 @@ class ConsultationPV:
     move: str
     score: int
     multipv_rank: int  # 1, 2, 3, ... (multipv無しの場合は1のみ)
+    depth: Optional[int] = None
 
 
 @dataclass
@@ -110,6 +116,7 @@ def consult(config, info: ConsultationInfo) -> ConsultationResult:
         # 各指し手候補について勝率を重みづけ和する
         # エンジン1の候補にあってエンジン2の候補にない=>エンジン1の値をそのまま利用
         # エンジン2の候補にあってエンジン2の候補にない=>その指し手は採用しない
+        # params.gap_fillを指定した場合は、上位候補手について両エンジンの評価値が補われている
         score_dicts = pv_to_winrate_dict(config, info)
         engine_weights = config["params"]["engine_weights"]
         assert len(score_dicts) == 2  # 3エンジン以上の場合の考慮はしてない
@@ -140,6 +147,114 @@ def consult(config, info: ConsultationInfo) -> ConsultationResult:
         raise ValueError("Unknown consult method")
 
 
+def parse_engine_pvs(pv_lines: List[str]) -> List[ConsultationPV]:
+    """
+    エンジンの出力行から、最後のmultipvの組だけを取り出す
+    """
+    # pv_linesの例。setoptionでmultipv=1のときは"multipv *"の要素はない。
+    """
+    [
+      "go btime 0 wtime 0 byoyomi 1000000",
+      "info depth 1 seldepth 1 score cp 361 multipv 1 nodes 435 nps 435000 time 1 pv 2g2f",
+      "info depth 1 seldepth 1 score cp 318 multipv 2 nodes 435 nps 435000 time 1 pv 4i5h",
+      "info depth 1 seldepth 1 score cp 315 multipv 3 nodes 435 nps 435000 time 1 pv 4g4f",
+      "info depth 2 seldepth 2 score cp 341 multipv 1 nodes 1281 nps 1281000 time 1 pv 3g3f 8c8d 2g2f",
+      "info depth 2 seldepth 2 score cp 332 multipv 2 nodes 1281 nps 1281000 time 1 pv 2g2f 8c8d",
+      "info depth 2 seldepth 2 score cp 296 multipv 3 nodes 1281 nps 1281000 time 1 pv 4i5h 8c8d 2g2f",
+      "info depth 3 seldepth 4 score cp 376 multipv 1 nodes 10011 nps 3337000 time 3 pv 8h7g 8c8d 2g2f",
+      "info depth 3 seldepth 4 score cp 296 multipv 2 nodes 10011 nps 3337000 time 3 pv 4g4f 8c8d 2g2f 4d4e",
+      "info depth 3 seldepth 4 score cp 287 multipv 3 nodes 10011 nps 3337000 time 3 pv 4i5h 4d4e 8h7g 3c7g+ 6h7g",
+      "bestmove 8h7g ponder 8c8d"
+    ]
+    """
+    pvs = []  # type: List[ConsultationPV]
+    for info_line in pv_lines[::-1]:
+        elems = info_line.split(" ")
+        if elems.pop(0) != "info":
+            continue
+
+        pv_first_move = None
+        multipv_rank = None
+        score = None
+        depth = None
+        while len(elems) > 0:
+            key = elems.pop(0)
+            if key in [
+                "seldepth",
+                "time",
+                "nodes",
+                "currmove",
+                "hashfull",
+                "nps",
+            ]:
+                # 引数1個、読み飛ばす
+                elems.pop(0)
+            elif key == "depth":
+                depth = int(elems.pop(0))
+            elif key == "string":
+                # PVではない
+                break
+            elif key == "pv":
+                pv_first_move = elems.pop(0)
+                break
+            elif key == "multipv":
+                multipv_rank = int(elems.pop(0))
+            elif key == "score":
+                if elems.pop(0) == "cp":
+                    # score cp 123
+                    score = int(elems.pop(0))
+                else:
+                    # score mate +3
+                    mate_count = elems.pop(0)
+                    if mate_count == "+":
+                        score = 32000
+                    elif mate_count == "-":
+                        score = -32000
+                    else:
+                        score = int(mate_count)
+                        if score > 0:
+                            score = 32000 - score
+                        else:
+                            # 10手詰めのとき、mate_count=-10で、score=-31980にしたい
+                            score = -32000 - score
+        if score is not None and pv_first_move is not None:
+            # multipv順位3,2,1の順に得られるが、pvsの中では1,2,3の順に並べたい
+            if (multipv_rank or 0) > 1 and depth < 5:
+                # 2番目以降の読み筋で、depthが極端に浅いものは除去(DLの場合、一切読んでいない指し手のPVも便宜上出てしまうため)
+                continue
+            pvs.insert(
+                0,
+                ConsultationPV(
+                    move=pv_first_move,
+                    score=score,
+                    multipv_rank=multipv_rank or 0,
+                    depth=depth,
+                ),
+            )
+            if (multipv_rank is None) or (multipv_rank == 1):
+                # multipv無しの場合は読み筋1個だけ。multipvありの場合、1が来たら最新の読み筋は終わり。
+                break
+    return pvs
+
+
+def extract_consultation_info(
+    engine_outputs,
+    move_count: int,
+    moves: Optional[List[str]],
+    sfen: str,
+) -> ConsultationInfo:
+    engine_pvs = []
+    engine_bestmoves = []
+    for engine_output in engine_outputs:
+        engine_bestmoves.append(engine_output["bestmove"])
+        engine_pvs.append(parse_engine_pvs(engine_output["pvs"]))
+
+    cinfo = ConsultationInfo(
+        engine_pvs=engine_pvs, engine_bestmoves=engine_bestmoves, move_count=move_count, moves=moves, sfen=sfen
+    )
+    return cinfo
+
+
 def run_go_in_thread(
     engine: Engine,
     moves: Optional[List[str]],
@@ -167,6 +282,165 @@ def run_go_in_thread(
         }
 
 
+def parse_setoption_lines(option: str) -> Dict[str, str]:
+    """
+    設定ファイルのoption("setoption name X value Y"の行の並び)をオプション名と値の辞書にする
+    """
+    options = {}
+    for setoption_line in option.split("\n"):
+        elems = setoption_line.strip().split(" ", 5)
+        if len(elems) < 5:
+            continue
+        options[elems[2]] = elems[4]
+    return options
+
+
+def engine_go_command(engine: Engine, cmd: str, listener: Callable):
+    """
+    cshogiのEngine.goが対応していない引数(searchmovesなど)を含むgoコマンドを送り、bestmoveまで待つ
+    """
+    listener(cmd)
+    engine.proc.stdin.write(cmd.encode("ascii") + b"\n")
+    engine.proc.stdin.flush()
+
+    while True:
+        line = engine.proc.stdout.readline()
+        if line == b"":
+            raise EOFError()
+        line = line.strip().decode(locale.getpreferredencoding())
+        listener(line)
+        if line[:8] == "bestmove":
+            items = line[9:].split(" ")
+            if len(items) == 3 and items[1] == "ponder":
+                return items[0], items[2]
+            else:
+                return items[0], None
+
+
+# go infiniteで保持するエンジン出力の行数(最新のmultipvの組が収まればよい)
+INFINITE_PV_LINES_MAX = 1000
+
+
+def run_go_infinite_in_thread(
+    engine: Engine,
+    moves: Optional[List[str]],
+    sfen: str,
+    snapshot: dict,
+    lock: Lock,
+):
+    """
+    stopが送られるまで思考させ、読み筋が出るたびにsnapshotを更新する
+    """
+    engine.position(moves=moves, sfen=sfen)
+
+    def listener(line):
+        if line.startswith("info "):
+            with lock:
+                snapshot["lines"].append(line)
+                snapshot["version"] += 1
+
+    bestmove, pondermove = engine_go_command(engine, "go infinite", listener)
+    with lock:
+        snapshot["bestmove"] = bestmove
+
+
+def run_gap_fill_in_thread(
+    engine: Engine,
+    moves: Optional[List[str]],
+    sfen: str,
+    searchmoves: List[str],
+    gap_fill_config: dict,
+    deadline: float,
+    lock: Lock,
+    result_container: Any,
+    result_container_idx: Any,
+):
+    """
+    指し手を1つずつsearchmovesで指定して短く探索し、その指し手の評価値を得る
+    deadline(time.time()の値)を過ぎる探索はしない。実行中の探索もdeadlineでstopする
+    """
+    filled_pvs = []
+    for move in searchmoves:
+        remaining_ms = int((deadline - time_module.time()) * 1000)
+        if remaining_ms <= 0:
+            break
+        engine.position(moves=moves, sfen=sfen)
+        if "nodes" in gap_fill_config:
+            # ノード数で探索量を決め、秒読みは残り時間の上限としてだけ使う
+            cmd = f"go btime 0 wtime 0 byoyomi {remaining_ms} nodes {gap_fill_config['nodes']}"
+        else:
+            cmd = f"go btime 0 wtime 0 byoyomi {min(gap_fill_config.get('byoyomi', 500), remaining_ms)}"
+        cmd += f" searchmoves {move}"
+        lines = []
+        # エンジンの時間制御(最小思考時間など)で秒読みを超える場合があるため、deadlineで強制的に止める
+        stop_timer = Timer(remaining_ms / 1000, engine.stop)
+        stop_timer.start()
+        try:
+            engine_go_command(engine, cmd, lines.append)
+        finally:
+            stop_timer.cancel()
+        pvs = parse_engine_pvs(lines)
+        # searchmoves非対応のエンジンでは別の指し手の読み筋が返るため、指定した指し手のものだけ採用
+        if len(pvs) > 0 and pvs[0].move == move:
+            filled_pvs.append(pvs[0])
+    with lock:
+        result_container[result_container_idx] = filled_pvs
+
+
+def reserve_gap_fill_time(time: Dict[str, int], gap_fill_config: dict, n_engines: int):
+    """
+    追加探索の時間を持ち時間から差し引き、本探索に渡す持ち時間と追加探索に使える時間[ms]を返す
+    追加探索は各エンジンで最大 candidates * (エンジン数 - 1) 手を順に行う
+    追加探索が必要かは本探索の後でないとわからないため、常に差し引く
+    """
+    budget = gap_fill_config.get("candidates", 3) * (n_engines - 1) * gap_fill_config.get("byoyomi", 500)
+    if "max_reserve" in gap_fill_config:
+        budget = min(budget, gap_fill_config["max_reserve"])
+    time = time.copy()
+    if time.get("byoyomi", 0) > 0:
+        # 秒読みの半分までを追加探索に充てる
+        budget = min(budget, time["byoyomi"] // 2)
+        time["byoyomi"] -= budget
+    else:
+        # 秒読みがない場合は残り時間から差し引く(エンジンの時間配分で調整される)
+        for key in ["btime", "wtime"]:
+            if key in time:
+                time[key] = max(time[key] - budget, 0)
+    return time, budget
+
+
+def setup_engine(engine: Engine, engine_config: Any) -> None:
+    """
+    設定ファイルのオプションを送り、readyokを待つ
+    """
+    for name, value in parse_setoption_lines(engine_config.get("option", "")).items():
+        engine.setoption(name=name, value=value)
+    engine.isready()
+
+
+def send_options_and_isready(engine: Engine, options: Dict[str, str]) -> None:
+    for name, value in options.items():
+        engine.setoption(name=name, value=value)
+    engine.isready()
+
+
+def run_engine_command_in_thread(
+    func: Callable,
+    engine: Engine,
+    engine_config: Any,
+    lock: Lock,
+    result_container: Any,
+    result_container_idx: Any,
+):
+    try:
+        func(engine, engine_config)
+        result = None
+    except Exception as ex:
+        result = ex
+    with lock:
+        result_container[result_container_idx] = result
+
+
 def boot_engine_thread(
     engine_config: Any,
     lock: Lock,
@@ -184,19 +458,34 @@ class Consultation:
     def __init__(self, config, usi_send) -> None:
         self.usi_send = usi_send
         self.config = config
-
-        self.engines = [None] * len(self.config["engines"])
+        book_path = self.config["params"].get("book")
+        self.book = load_book(book_path) if book_path else None
+
+        self._infinite = None  # go infinite中の状態
+        feed_port = self.config["params"].get("feed_port")
+        self.feed = ConsultFeed(feed_port) if feed_port else None
+        calibration_file = self.config["params"].get("calibration_file")
+        self.calibration = OnlineCalibration(calibration_file) if calibration_file else None
+        if self.calibration is not None:
+            self.calibration.apply(self.config["engines"])
+        self._reload_lock = Lock()
+        self._pending_config = None  # apply_pending_config()で反映する設定
+        self._options_overridden = set()  # 設定ファイルと異なるオプションを送ったエンジン
+        self.engines = self._boot_engines(self.config["engines"])
+
+    def _boot_engines(self, engine_configs) -> List[Engine]:
+        engines = [None] * len(engine_configs)
         threads = []
         lock = Lock()
         # 同時に起動する必要があるためスレッドを用いる。
         # iPadから2つのTCPコネクションを同時に張る仕様となっているため。
-        for i, engine_config in enumerate(self.config["engines"]):
+        for i, engine_config in enumerate(engine_configs):
             t = Thread(
                 target=boot_engine_thread,
                 kwargs={
                     "engine_config": engine_config,
                     "lock": lock,
-                    "result_container": self.engines,
+                    "result_container": engines,
                     "result_container_idx": i,
                 },
             )
@@ -204,20 +493,158 @@ class Consultation:
             threads.append(t)
         for t in threads:
             t.join()
+        return engines
+
+    def _run_on_engines(self, command: str, func: Callable, engines=None, engine_configs=None) -> None:
+        """
+        全エンジンに同時にfunc(engine, engine_config)を実行させ、すべて終わるまで待つ
+        待っている間はGUIにタイムアウトと判断されないよう、定期的にinfo stringで進捗を送る
+        """
+        if engines is None:
+            engines = self.engines
+            engine_configs = self.config["engines"]
+        timeout = self.config["params"].get("lifecycle_timeout")  # [秒]、省略時は無制限
+        # 0以下を指定されても進捗の送信が止まらなくならないよう下限を設ける
+        keepalive_interval = max(self.config["params"].get("keepalive_interval", 5.0), 0.1)
+
+        # 終了したエンジンの結果(例外またはNone)が入る。未終了はFalse
+        results = [False] * len(engines)
+        threads = []
+        lock = Lock()
+        for i, (engine, engine_config) in enumerate(zip(engines, engine_configs)):
+            t = Thread(
+                target=run_engine_command_in_thread,
+                kwargs={
+                    "func": func,
+                    "engine": engine,
+                    "engine_config": engine_config,
+                    "lock": lock,
+                    "result_container": results,
+                    "result_container_idx": i,
+                },
+                daemon=True,  # タイムアウトしたエンジンがプロキシの終了を妨げないようにする
+            )
+            t.start()
+            threads.append(t)
+
+        start_time = time_module.time()
+        next_keepalive = start_time + keepalive_interval
+        while True:
+            alive_threads = [t for t in threads if t.is_alive()]
+            if len(alive_threads) == 0:
+                break
+            now = time_module.time()
+            elapsed = now - start_time
+            if timeout is not None and elapsed >= timeout:
+                with lock:
+                    pending = [i for i, result in enumerate(results) if result is False]
+                raise TimeoutError(f"{command} timed out after {timeout}s, engines {pending} not responding")
+            if now >= next_keepalive:
+                self.usi_send(
+                    f"info string {command} waiting {len(threads) - len(alive_threads)}/{len(threads)} engines done, {int(elapsed)}s elapsed"
+                )
+                next_keepalive += keepalive_interval
+            wait = next_keepalive - now
+            if timeout is not None:
+                wait = min(wait, timeout - elapsed)
+            alive_threads[0].join(timeout=max(wait, 0.0))
+
+        for result in results:
+            if result is not None:
+                raise result
 
     def isready(self) -> None:
+        self.apply_pending_config()
+        self._publish({"type": "newgame"})
         # setoptionをやり直す(一定手数以上でMultiPVが解除されているため)
-        for engine, engine_config in zip(self.engines, self.config["engines"]):
-            for setoption_line in engine_config.get("option", "").split("\n"):
-                elems = setoption_line.strip().split(" ", 5)
-                if len(elems) < 5:
+        self._run_on_engines("isready", setup_engine)
+        self._options_overridden.clear()
+
+    def request_reload(self, config) -> None:
+        """
+        設定ファイルの監視スレッドなどから呼ばれ、apply_pending_config()で設定を反映させる
+        """
+        with self._reload_lock:
+            self._pending_config = config
+
+    def apply_pending_config(self) -> None:
+        """
+        要求された設定を反映する。エンジンの起動やisreadyで持ち時間を使わないよう、
+        対局の間(isready・gameover)でだけ呼ぶ
+        """
+        with self._reload_lock:
+            config = self._pending_config
+            self._pending_config = None
+        if config is not None:
+            self.reload(config)
+
+    def reload(self, config) -> None:
+        """
+        実行中のエンジンを再起動せずに設定を反映する
+        exeが同じエンジンはそのまま使い、変更されたオプションだけを送る。追加・削除されたエンジンだけを起動・終了する。
+        対局中には呼ばないこと(対局の間に呼ぶ)
+        """
+        old_engines = list(zip(self.engines, self.config["engines"]))
+        engines = [None] * len(config["engines"])
+        changed_engines = []
+        changed_engine_options = []
+        for i, engine_config in enumerate(config["engines"]):
+            for j, (engine, old_engine_config) in enumerate(old_engines):
+                if engine is None or old_engine_config["exe"] != engine_config["exe"]:
                     continue
-                engine.setoption(name=elems[2], value=elems[4])
-            engine.isready()
+                old_options = parse_setoption_lines(old_engine_config.get("option", ""))
+                if engine in self._options_overridden:
+                    # _go_no_consultでMultiPVを変更しているため、設定ファイルのオプションをすべて送り直す
+                    old_options = {}
+                    self._options_overridden.discard(engine)
+                changed_options = {
+                    name: value
+                    for name, value in parse_setoption_lines(engine_config.get("option", "")).items()
+                    if old_options.get(name) != value
+                }
+                if len(changed_options) > 0:
+                    changed_engines.append(engine)
+                    changed_engine_options.append(changed_options)
+                engines[i] = engine
+                old_engines[j] = (None, None)
+                break
+
+        # DLエンジンではオプションの変更でモデルを読み直すことがあるため、isreadyと同様に同時に待つ
+        self._run_on_engines("isready", send_options_and_isready, changed_engines, changed_engine_options)
+
+        removed_engines = [engine for engine, _ in old_engines if engine is not None]
+        for engine in removed_engines:
+            self._options_overridden.discard(engine)
+            engine.quit()
+
+        boot_idxs = [i for i, engine in enumerate(engines) if engine is None]
+        booted_engines = self._boot_engines([config["engines"][i] for i in boot_idxs])
+        booted_engine_configs = [config["engines"][i] for i in boot_idxs]
+        self._run_on_engines("isready", setup_engine, booted_engines, booted_engine_configs)
+        self._run_on_engines(
+            "usinewgame", lambda engine, engine_config: engine.usinewgame(), booted_engines, booted_engine_configs
+        )
+        for i, engine in zip(boot_idxs, booted_engines):
+            engines[i] = engine
+
+        if config["params"].get("book") != self.config["params"].get("book"):
+            book_path = config["params"].get("book")
+            self.book = load_book(book_path) if book_path else None
+        if self.calibration is not None:
+            # 設定ファイルの係数より、対局中に更新した係数を優先する
+            self.calibration.apply(config["engines"])
+        # エンジンと設定を同時に差し替える
+        self.engines, self.config = engines, config
+        self.usi_send(
+            f"info string config reloaded kept={len(engines) - len(boot_idxs)} booted={len(boot_idxs)} quit={len(removed_engines)}"
+        )
+
+    def _publish(self, event: dict) -> None:
+        if self.feed is not None:
+            self.feed.publish(event)
 
     def usinewgame(self) -> None:
-        for engine in self.engines:
-            engine.usinewgame()
+        self._run_on_engines("usinewgame", lambda engine, engine_config: engine.usinewgame())
 
     def _go_no_consult(self, moves, sfen, time):
         """
@@ -225,6 +652,7 @@ class Consultation:
         """
         engine = self.engines[0]
         engine.setoption("MultiPV", "1")
+        self._options_overridden.add(engine)
         cont = [None]
         t = Thread(
             target=run_go_in_thread,
@@ -253,7 +681,7 @@ class Consultation:
         move_count = len(moves) + 1  # 現在何手目か
         no_consult = move_count > self.config["params"]["max_move_count"]
 
-        book_move = get_book_move(moves, sfen)
+        book_move = get_book_move(moves, sfen, self.book)
         if book_move is not None:
             self.usi_send(f"info string book move")
             return book_move
@@ -261,6 +689,10 @@ class Consultation:
         if no_consult:
             return self._go_no_consult(moves, sfen, time)
 
+        gap_fill_config = self.config["params"].get("gap_fill")
+        if gap_fill_config:
+            time, gap_fill_budget = reserve_gap_fill_time(time, gap_fill_config, len(self.engines))
+
         engine_outputs = [None] * len(self.engines)
         threads = []
         lock = Lock()
@@ -288,17 +720,175 @@ class Consultation:
         consult_info = self._extract_consultation_info(
             engine_outputs, move_count, moves, sfen
         )
+        if self.calibration is not None:
+            # 各エンジンの最善手の評価値を、対局結果とともに勝率の回帰に使う
+            for engine_idx, (engine_config, pvs) in enumerate(zip(self.config["engines"], consult_info.engine_pvs)):
+                if len(pvs) > 0:
+                    self.calibration.record(engine_key(engine_idx, engine_config), pvs[0].score)
+        if gap_fill_config:
+            self._fill_pv_gaps(consult_info, gap_fill_config, gap_fill_budget)
         self.usi_send(f"info string engine_outputs {json.dumps(engine_outputs)}")
         self.usi_send(
             f"info string engine0={engine_outputs[0]['bestmove']} engine1={engine_outputs[1]['bestmove']}"
         )
         consult_result = consult(self.config, consult_info)
         self.usi_send(f"info string consult {json.dumps(consult_result.comment)}")
+        self._publish({"type": "consult", **consult_result.comment})
         self.usi_send(
             f"info depth 1 score cp {winrate_to_score_cp_standard(consult_result.winrate)} pv {consult_result.bestmove}"
         )
         return consult_result.bestmove
 
+    def go_infinite(self, moves, sfen) -> None:
+        """
+        全エンジンにgo infiniteで思考させ、stopまで一定間隔で合議結果を出力する
+        呼び出しはすぐに戻り、stop()で最善手を得る
+        """
+        lock = Lock()
+        snapshots = [
+            {"lines": deque(maxlen=INFINITE_PV_LINES_MAX), "version": 0, "bestmove": None}
+            for _ in self.engines
+        ]
+        threads = []
+        for engine, snapshot in zip(self.engines, snapshots):
+            t = Thread(
+                target=run_go_infinite_in_thread,
+                kwargs={
+                    "engine": engine,
+                    "moves": moves,
+                    "sfen": sfen,
+                    "snapshot": snapshot,
+                    "lock": lock,
+                },
+            )
+            t.start()
+            threads.append(t)
+        self._infinite = {
+            "moves": moves,
+            "sfen": sfen,
+            "lock": lock,
+            "snapshots": snapshots,
+            "threads": threads,
+            "last_versions": [0] * len(self.engines),
+            "engine_pvs": [[] for _ in self.engines],
+            "stop_event": Event(),
+        }
+        consult_thread = Thread(target=self._consult_infinite_loop)
+        consult_thread.start()
+        self._infinite["consult_thread"] = consult_thread
+
+    def _consult_infinite_loop(self) -> None:
+        interval = self.config["params"].get("infinite_interval", 1.0)
+        while not self._infinite["stop_event"].wait(interval):
+            consult_result = self._consult_infinite()
+            if consult_result is None or len(consult_result.comment["score_tuples"]) == 0:
+                continue
+            self._publish({"type": "consult", **consult_result.comment})
+            # 合議後の勝率順にmultipvとして出力する
+            depth = self._infinite["depth"]
+            for rank, (move, winrate) in enumerate(consult_result.comment["score_tuples"]):
+                self.usi_send(
+                    f"info depth {depth} score cp {winrate_to_score_cp_standard(winrate)} multipv {rank + 1} pv {move}"
+                )
+
+    def _consult_infinite(self, force: bool = False) -> Optional[ConsultationResult]:
+        """
+        前回から読み筋が更新されたエンジンの出力だけを解析し直して合議する
+        更新がなければNoneを返す
+        """
+        state = self._infinite
+        changed = False
+        engine_bestmoves = []
+        with state["lock"]:
+            for i, snapshot in enumerate(state["snapshots"]):
+                engine_bestmoves.append(snapshot["bestmove"])
+                if snapshot["version"] != state["last_versions"][i]:
+                    state["last_versions"][i] = snapshot["version"]
+                    state["engine_pvs"][i] = parse_engine_pvs(list(snapshot["lines"]))
+                    changed = True
+        if not (changed or force):
+            return None
+        depths = [pvs[0].depth for pvs in state["engine_pvs"] if len(pvs) > 0 and pvs[0].depth is not None]
+        state["depth"] = min(depths) if len(depths) > 0 else 1
+        consult_info = ConsultationInfo(
+            moves=state["moves"],
+            sfen=state["sfen"],
+            move_count=len(state["moves"]) + 1,
+            engine_bestmoves=engine_bestmoves,
+            engine_pvs=[list(pvs) for pvs in state["engine_pvs"]],
+        )
+        return consult(self.config, consult_info)
+
+    def stop(self) -> str:
+        """
+        go infiniteを終了し、合議結果の最善手を返す
+        """
+        state = self._infinite
+        for engine in self.engines:
+            engine.stop()
+        for t in state["threads"]:
+            t.join()
+        state["stop_event"].set()
+        state["consult_thread"].join()
+        consult_result = self._consult_infinite(force=True)
+        self._infinite = None
+        self.usi_send(f"info string consult {json.dumps(consult_result.comment)}")
+        self._publish({"type": "consult", **consult_result.comment})
+        self.usi_send(
+            f"info depth {state['depth']} score cp {winrate_to_score_cp_standard(consult_result.winrate)} pv {consult_result.bestmove}"
+        )
+        return consult_result.bestmove
+
+    def _fill_pv_gaps(self, consult_info: ConsultationInfo, gap_fill_config: dict, budget: int) -> None:
+        """
+        いずれかのエンジンの上位候補手のうち、読み筋に含まれないエンジンがあるものについて
+        そのエンジンで追加探索し、consult_info.engine_pvsに評価値を補う
+        追加探索は合計budget[ms]以内に収める
+        """
+        deadline = time_module.time() + budget / 1000
+        candidates = gap_fill_config.get("candidates", 3)
+        shortlist = []
+        for pvs in consult_info.engine_pvs:
+            for pv in pvs[:candidates]:
+                if pv.move not in shortlist:
+                    shortlist.append(pv.move)
+
+        filled_pvs = [[] for _ in self.engines]
+        threads = []
+        lock = Lock()
+        for i, engine in enumerate(self.engines):
+            known_moves = [pv.move for pv in consult_info.engine_pvs[i]]
+            searchmoves = [move for move in shortlist if move not in known_moves]
+            if len(searchmoves) == 0:
+                continue
+            t = Thread(
+                target=run_gap_fill_in_thread,
+                kwargs={
+                    "engine": engine,
+                    "moves": consult_info.moves,
+                    "sfen": consult_info.sfen,
+                    "searchmoves": searchmoves,
+                    "gap_fill_config": gap_fill_config,
+                    "deadline": deadline,
+                    "lock": lock,
+                    "result_container": filled_pvs,
+                    "result_container_idx": i,
+                },
+            )
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        for pvs, engine_filled_pvs in zip(consult_info.engine_pvs, filled_pvs):
+            for pv in engine_filled_pvs:
+                # 補った指し手はmultipv順位の末尾として扱う
+                pv.multipv_rank = len(pvs) + 1
+                pvs.append(pv)
+        self.usi_send(
+            f"info string gap_fill {json.dumps([[pv.move for pv in engine_filled_pvs] for engine_filled_pvs in filled_pvs])}"
+        )
+
     def _extract_consultation_info(
         self,
         engine_outputs,
@@ -306,99 +896,11 @@ class Consultation:
         moves: Optional[List[str]],
         sfen: str,
     ) -> ConsultationInfo:
-        engine_pvs = []
-        engine_bestmoves = []
-        for engine_output in engine_outputs:
-            # pvsの例。最後のmultipvだけを取り出す。setoptionでmultipv=1のときは"multipv *"の要素はない。
-            """
-                        "pvs": [
-              "go btime 0 wtime 0 byoyomi 1000000",
-              "info depth 1 seldepth 1 score cp 361 multipv 1 nodes 435 nps 435000 time 1 pv 2g2f",
-              "info depth 1 seldepth 1 score cp 318 multipv 2 nodes 435 nps 435000 time 1 pv 4i5h",
-              "info depth 1 seldepth 1 score cp 315 multipv 3 nodes 435 nps 435000 time 1 pv 4g4f",
-              "info depth 2 seldepth 2 score cp 341 multipv 1 nodes 1281 nps 1281000 time 1 pv 3g3f 8c8d 2g2f",
-              "info depth 2 seldepth 2 score cp 332 multipv 2 nodes 1281 nps 1281000 time 1 pv 2g2f 8c8d",
-              "info depth 2 seldepth 2 score cp 296 multipv 3 nodes 1281 nps 1281000 time 1 pv 4i5h 8c8d 2g2f",
-              "info depth 3 seldepth 4 score cp 376 multipv 1 nodes 10011 nps 3337000 time 3 pv 8h7g 8c8d 2g2f",
-              "info depth 3 seldepth 4 score cp 296 multipv 2 nodes 10011 nps 3337000 time 3 pv 4g4f 8c8d 2g2f 4d4e",
-              "info depth 3 seldepth 4 score cp 287 multipv 3 nodes 10011 nps 3337000 time 3 pv 4i5h 4d4e 8h7g 3c7g+ 6h7g",
-              "bestmove 8h7g ponder 8c8d"
-            ]
-            """
-            engine_bestmoves.append(engine_output["bestmove"])
-            pvs = []  # type: List[ConsultationPV]
-            for info_line in engine_output["pvs"][::-1]:
-                elems = info_line.split(" ")
-                if elems.pop(0) != "info":
-                    continue
-
-                pv_first_move = None
-                multipv_rank = None
-                score = None
-                depth = None
-                while len(elems) > 0:
-                    key = elems.pop(0)
-                    if key in [
-                        "seldepth",
-                        "time",
-                        "nodes",
-                        "currmove",
-                        "hashfull",
-                        "nps",
-                    ]:
-                        # 引数1個、読み飛ばす
-                        elems.pop(0)
-                    elif key == "depth":
-                        depth = int(elems.pop(0))
-                    elif key == "string":
-                        # PVではない
-                        break
-                    elif key == "pv":
-                        pv_first_move = elems.pop(0)
-                        break
-                    elif key == "multipv":
-                        multipv_rank = int(elems.pop(0))
-                    elif key == "score":
-                        if elems.pop(0) == "cp":
-                            # score cp 123
-                            score = int(elems.pop(0))
-                        else:
-                            # score mate +3
-                            mate_count = elems.pop(0)
-                            if mate_count == "+":
-                                score = 32000
-                            elif mate_count == "-":
-                                score = -32000
-                            else:
-                                score = int(mate_count)
-                                if score > 0:
-                                    score = 32000 - score
-                                else:
-                                    # 10手詰めのとき、mate_count=-10で、score=-31980にしたい
-                                    score = -32000 - score
-                if score is not None and pv_first_move is not None:
-                    # multipv順位3,2,1の順に得られるが、pvsの中では1,2,3の順に並べたい
-                    if (multipv_rank or 0) > 1 and depth < 5:
-                        # 2番目以降の読み筋で、depthが極端に浅いものは除去(DLの場合、一切読んでいない指し手のPVも便宜上出てしまうため)
-                        continue
-                    pvs.insert(
-                        0,
-                        ConsultationPV(
-                            move=pv_first_move,
-                            score=score,
-                            multipv_rank=multipv_rank or 0,
-                        ),
-                    )
-                    if (multipv_rank is None) or (multipv_rank == 1):
-                        # multipv無しの場合は読み筋1個だけ。multipvありの場合、1が来たら最新の読み筋は終わり。
-                        break
-            engine_pvs.append(pvs)
-
-        cinfo = ConsultationInfo(
-            engine_pvs=engine_pvs, engine_bestmoves=engine_bestmoves, move_count=move_count, moves=moves, sfen=sfen
-        )
-        return cinfo
+        return extract_consultation_info(engine_outputs, move_count, moves, sfen)
 
     def gameover(self, result: Optional[str]) -> None:
-        for engine in self.engines:
-            engine.gameover(result)
+        if self.calibration is not None:
+            self.calibration.gameover(self.config["engines"], result)
+        self._run_on_engines("gameover", lambda engine, engine_config: engine.gameover(result))
+        # この対局の記録を集計した後で設定を差し替える
+        self.apply_pending_config()
@@ -0,0 +1,76 @@
+"""
+合議結果をlocalhostのHTTP(Server-Sent Events)で配信する
+streamlit_visualize.py --feed http://127.0.0.1:<port>/ で購読する
+"""
+
+import json
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import List
+
+# 購読者が一定時間イベントを受け取らない場合に送るコメント行の間隔[秒]。切断の検出に用いる
+KEEPALIVE_INTERVAL = 15.0
+
+
+class ConsultFeed:
+    def __init__(self, port: int, queue_size: int = 16) -> None:
+        self.queue_size = queue_size
+        self.subscribers = []  # type: List[queue.Queue]
+        self.lock = Lock()
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                feed._serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def publish(self, event: dict) -> None:
+        """
+        全購読者のキューにイベントを入れる。合議の処理を止めないよう、待機はしない
+        """
+        data = json.dumps(event)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                # 読み取りが遅い購読者には、古いイベントを捨てて最新のものを渡す
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    pass
+
+    def _serve(self, handler: BaseHTTPRequestHandler) -> None:
+        q = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.append(q)
+        try:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/event-stream")
+            handler.send_header("Cache-Control", "no-cache")
+            handler.end_headers()
+            while True:
+                try:
+                    data = q.get(timeout=KEEPALIVE_INTERVAL)
+                    handler.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                except queue.Empty:
+                    handler.wfile.write(b": keepalive\n\n")
+                handler.wfile.flush()
+        except ConnectionError:
+            # 閲覧側の切断(WindowsではConnectionAbortedErrorになることが多い)
+            pass
+        finally:
+            with self.lock:
+                self.subscribers.remove(q)
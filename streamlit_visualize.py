@@ -1,9 +1,11 @@
 # streamlit run streamlit_visualize.py -- xxx.log
+# streamlit run streamlit_visualize.py -- --feed http://127.0.0.1:8765/
 # 合議結果をリアルタイム可視化するツール
 
 import argparse
 import time
 import json
+import urllib.request
 from cshogi import Board
 from cshogi.KIF import move_to_kif
 import streamlit as st
@@ -16,23 +18,19 @@ class ReadLine:
     """
     def __init__(self, f) -> None:
         self.f = f
-        self.buffer = ""
-    
+        self.buffer = ""  # 書き込み途中の行
+
     def readline(self) -> str:
-        nl = self.buffer.find("\n")
-        if nl >= 0:
-            ret = self.buffer[:nl]
-            self.buffer = self.buffer[nl+1:]
-            return ret
         while True:
-            data = self.f.read()
-            self.buffer += data
-            nl = self.buffer.find("\n")
-            if nl >= 0:
-                ret = self.buffer[:nl]
-                self.buffer = self.buffer[nl+1:]
+            line = self.f.readline()
+            if line == "":
+                time.sleep(1)
+                continue
+            self.buffer += line
+            if self.buffer.endswith("\n"):
+                ret = self.buffer[:-1]
+                self.buffer = ""
                 return ret
-            time.sleep(1)
 
 CONSULT_RESULT_PREFIX = "info string consult "
 BESTMOVE_PREFIX = "bestmove "
@@ -51,15 +49,34 @@ def score_tuples_to_dataframe(score_tuples, board):
         "winrate": [f"{int(t[1] * 100)}%" for t in score_tuples],
     })
 
-def parse_consult_result(line, phs, context):
-    json_str = line[len(CONSULT_RESULT_PREFIX):]
-    consult_obj = json.loads(json_str)
+class IncrementalBoard:
+    """
+    前回の局面からの指し手だけを進めて局面を更新する
+    """
+    def __init__(self) -> None:
+        self.board = Board()
+        self.sfen = None
+        self.moves = []
 
-    board = Board()
-    pos_str = consult_obj["sfen"]
-    if consult_obj["moves"] not in (None, []):
-        pos_str += " moves " + " ".join(consult_obj["moves"])
-    board.set_position(pos_str)
+    def set_position(self, sfen, moves) -> Board:
+        moves = moves or []
+        if sfen != self.sfen or moves[:len(self.moves)] != self.moves:
+            # 別の対局や待ったの場合は局面を作り直す
+            self.board.set_position(sfen)
+            self.sfen = sfen
+            self.moves = []
+        try:
+            for move in moves[len(self.moves):]:
+                self.board.push_usi(move)
+                self.moves.append(move)
+        except Exception:
+            # 途中まで進めた局面は使わず、次回作り直す
+            self.sfen = None
+            raise
+        return self.board
+
+def parse_consult_result(consult_obj, phs, context, incremental_board):
+    board = incremental_board.set_position(consult_obj["sfen"], consult_obj["moves"])
 
     phs["result"].write(score_tuples_to_dataframe(consult_obj["score_tuples"], board))
     nnue_st = score_dict_to_tuples(consult_obj["engine_score_dicts"][0])
@@ -79,7 +96,42 @@ def parse_consult_result(line, phs, context):
     phs["nnue_best_ratio"].write(f'NNUE最善手採択率 {int(context["nnue_best_chosen_count"] / context["consult_count"] * 100)}%')
 
 
-def process(f):
+def read_log_events(f):
+    """
+    ログファイルから("newgame", None)または("consult", 合議結果)を読み出す
+    """
+    rl = ReadLine(f)
+    while True:
+        line = rl.readline()
+        try:
+            if line == "readyok":
+                # 新しい対局
+                yield "newgame", None
+            if line.startswith(CONSULT_RESULT_PREFIX):
+                yield "consult", json.loads(line[len(CONSULT_RESULT_PREFIX):])
+            if line.startswith(BESTMOVE_PREFIX):
+                pass
+        except Exception as ex:
+            st.write("Error processing " + line + repr(ex))
+
+def read_feed_events(url):
+    """
+    usiproxy.pyの配信(params.feed_port)を購読し、read_log_eventsと同じ形式で読み出す
+    """
+    while True:
+        try:
+            with urllib.request.urlopen(url) as res:
+                for raw_line in res:
+                    line = raw_line.decode("utf-8").rstrip("\r\n")
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    yield event.pop("type"), event
+        except OSError:
+            # プロキシの起動前や再起動中
+            time.sleep(1)
+
+def process(events):
     phs = {}
     st.write("合議結果")
     phs["result"] = st.empty()
@@ -88,26 +140,26 @@ def process(f):
     st.write("DLの出力")
     phs["deep"] = st.empty()
     phs["nnue_best_ratio"] = st.empty()
-    rl = ReadLine(f)
     context = CONTEXT_INIT.copy()
-    while True:
-        line = rl.readline()
+    incremental_board = IncrementalBoard()
+    for event_type, consult_obj in events:
         try:
-            if line == "readyok":
-                # 新しい対局
+            if event_type == "newgame":
                 context = CONTEXT_INIT.copy()
-            if line.startswith(CONSULT_RESULT_PREFIX):
-                parse_consult_result(line, phs, context)
-            if line.startswith(BESTMOVE_PREFIX):
-                pass
+            if event_type == "consult":
+                parse_consult_result(consult_obj, phs, context, incremental_board)
         except Exception as ex:
-            st.write("Error processing " + line + repr(ex))
+            st.write("Error processing " + json.dumps(consult_obj) + repr(ex))
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("log")
+    parser.add_argument("log", nargs="?")
+    parser.add_argument("--feed", help="usiproxy.pyの配信URL(例: http://127.0.0.1:8765/)")
     args = parser.parse_args()
-    with open(args.log, "r") as f:
-        process(f)
+    if args.feed:
+        process(read_feed_events(args.feed))
+    else:
+        with open(args.log, "r") as f:
+            process(read_log_events(f))
 
 main()
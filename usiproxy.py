@@ -1,9 +1,12 @@
 """
 USIエンジンとしてふるまい、ただ別のUSIエンジンを呼び出して指し手を中継する
-ponderは考えない(思考中にメッセージが来ることに対応しない)
+ponderは考えない(go infiniteを除き、思考中にメッセージが来ることに対応しない)
 """
 
 import argparse
+import os
+import time
+from threading import Thread
 import yaml
 import cshogi
 from consultation import Consultation
@@ -11,10 +14,45 @@ from consultation import Consultation
 def usi_send(msg: str):
     print(msg, flush=True)
 
+def load_reload_config(path: str):
+    """
+    再読み込み用に設定ファイルを読む。読めない場合はGUIに通知してNoneを返す
+    """
+    try:
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        if not isinstance(config, dict) or "engines" not in config or "params" not in config:
+            raise ValueError("engines and params are required")
+        return config
+    except Exception as ex:
+        # 保存途中のファイルを読んだ場合など
+        ex_str = repr(ex).replace('\n', '\\n')
+        usi_send(f"info string config reload failed {ex_str}")
+        return None
+
+def watch_config_file(path: str, consultation: Consultation):
+    """
+    設定ファイルの更新を監視し、対局の間(isready・gameover)に反映させる
+    """
+    last_mtime = os.path.getmtime(path)
+    while True:
+        time.sleep(1)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        config = load_reload_config(path)
+        if config is not None:
+            consultation.request_reload(config)
+
 def usi_loop(commandline_args):
     consultation = None
     config = {}
     last_position = None
+    infinite = False  # go infiniteで思考中
     while True:
         try:
             msg_recv = input()
@@ -24,20 +62,36 @@ def usi_loop(commandline_args):
         command = params[0]
         args = params[1:]
         if command == "quit":
+            if infinite:
+                consultation.stop()
             break
+        elif command == "stop":
+            if infinite:
+                bestmove = consultation.stop()
+                infinite = False
+                usi_send(f"bestmove {bestmove}")
         elif command == "usi":
             usi_send(f"id name {commandline_args.name}")
             usi_send(f"id author {commandline_args.author}")
             # usi_send("option name optionfile type filename default <empty>")
+            usi_send("option name ReloadConfig type button")
             # isreadyのタイミングでエンジンを起動数ると
             with open(commandline_args.config) as f:
                 config = yaml.safe_load(f)
                 consultation = Consultation(config, usi_send)
+            if config["params"].get("watch_config"):
+                Thread(target=watch_config_file, args=(commandline_args.config, consultation), daemon=True).start()
             usi_send("usiok")
         elif command == "setoption":
             # setoption name USI_Ponder value true
             option_name = args[1]
             option_value = " ".join(args[3:])
+            if option_name == "ReloadConfig":
+                # 設定ファイルを読み直し、起動済みのエンジンは再起動せずに反映する
+                reload_config = load_reload_config(commandline_args.config)
+                if reload_config is not None:
+                    # 対局中の持ち時間を使わないよう、次のisready・gameoverで反映する
+                    consultation.request_reload(reload_config)
             # if option_name == "optionfile":
             #     if consultation is None: # 2回目以降の対局では起動済みエンジンをそのまま使う
             #         with open(option_value) as f:
@@ -56,6 +110,11 @@ def usi_loop(commandline_args):
             if len(args) > 0 and args[0] == "ponder":
                 # ponder未対応
                 continue
+            if len(args) > 0 and args[0] == "infinite":
+                # 検討モード。stopが来るまで合議結果を出力し続ける
+                consultation.go_infinite(moves=last_position["moves"], sfen=last_position["sfen"])
+                infinite = True
+                continue
 
             # 持ち時間に関する引数
             time_args = {}